@@ -28,7 +28,7 @@ class SecretsResponse(BaseModel):
         }
 
 class ServiceList(BaseModel):
-    """Model for listing services that have stored secrets"""
+    """Model for listing a page of services that have stored secrets"""
     services: list[str]
     total_count: int
 
@@ -1,13 +1,25 @@
 ﻿from datetime import datetime
-from fastapi import APIRouter, Depends, HTTPException, status, Form, Query
-from ...core.security import verify_api_key, create_api_key 
-from ...services.kms import get_kms, AsyncKMS
+from fastapi import APIRouter, Depends, HTTPException, Request, status, Form, Query
+from fastapi.responses import ORJSONResponse
+from ...core.security import verify_api_key, create_api_key, revoke_api_key
+from ...services.kms import AsyncKMS
 from ...core.config import settings
 from ..models.secret import SecretsResponse, ServiceList, APIKeyResponse
-import json
+import orjson
 
 router = APIRouter()
 
+async def get_app_kms(request: Request) -> AsyncKMS:
+    """Return the KMS instance bound to app state at startup"""
+    return request.app.state.kms
+
+async def get_request_time(request: Request) -> datetime:
+    """Return the request timestamp, taken once and reused for the request"""
+    now = getattr(request.state, "now", None)
+    if now is None:
+        now = request.state.now = datetime.now()
+    return now
+
 @router.post(
     "/{service_name}",
     response_model=SecretsResponse,
@@ -18,29 +30,36 @@ async def store_secret(
     service_name: str,
     secret_data: str = Form(..., description="Secret content"),
     metadata: str = Form(default="{}", description="Optional JSON metadata"),
-    kms: AsyncKMS = Depends(get_kms)
-) -> SecretsResponse:
+    kms: AsyncKMS = Depends(get_app_kms),
+    now: datetime = Depends(get_request_time)
+) -> ORJSONResponse:
     """Store a secret for a service"""
     try:
         # Parse metadata if provided
-        meta_dict = json.loads(metadata)
+        meta_dict = orjson.loads(metadata)
         
         # Add timestamp to metadata
-        meta_dict["stored_at"] = str(datetime.now())
+        stored_at = now.isoformat()
+        meta_dict["stored_at"] = stored_at
         
         await kms.store_secret(
             service_name=service_name,
             secret_data=secret_data,
-            metadata=meta_dict
+            metadata=meta_dict,
+            created_at=stored_at
         )
         
-        return SecretsResponse(
-            service_name=service_name,
-            secret=secret_data,
-            metadata=meta_dict,
-            created_at=meta_dict["stored_at"]
+        # Fields are already well-typed, so skip re-validating the response model
+        return ORJSONResponse(
+            status_code=status.HTTP_201_CREATED,
+            content={
+                "service_name": service_name,
+                "secret": secret_data,
+                "metadata": meta_dict,
+                "created_at": stored_at
+            }
         )
-    except json.JSONDecodeError:
+    except orjson.JSONDecodeError:
         raise HTTPException(
             status_code=status.HTTP_400_BAD_REQUEST,
             detail="Invalid metadata JSON format"
@@ -58,18 +77,19 @@ async def store_secret(
 )
 async def get_secret(
     service_name: str,
-    kms: AsyncKMS = Depends(get_kms),
+    kms: AsyncKMS = Depends(get_app_kms),
     api_key: str = Depends(verify_api_key)
-) -> SecretsResponse:
+) -> ORJSONResponse:
     """Retrieve a secret and its metadata"""
     try:
         secret_info = await kms.get_secret(service_name)
-        return SecretsResponse(
-            service_name=service_name,
-            secret=secret_info["secret"].decode(),
-            metadata=secret_info["metadata"],
-            created_at=secret_info["metadata"]["stored_at"]
-        )
+        # Decrypted fields are trusted, so skip response model validation
+        return ORJSONResponse({
+            "service_name": service_name,
+            "secret": secret_info["secret"].decode(),
+            "metadata": secret_info["metadata"],
+            "created_at": secret_info["created_at"]
+        })
     except FileNotFoundError:
         raise HTTPException(
             status_code=status.HTTP_404_NOT_FOUND,
@@ -82,12 +102,15 @@ async def get_secret(
     summary="List all secret services"
 )
 async def list_secrets(
-    kms: AsyncKMS = Depends(get_kms),
+    limit: int = Query(default=500, gt=0, le=1000),
+    offset: int = Query(default=0, ge=0),
+    kms: AsyncKMS = Depends(get_app_kms),
     api_key: str = Depends(verify_api_key)
-) -> ServiceList:
-    """List all services that have stored secrets"""
-    services = await kms.list_services()
-    return ServiceList(services=services, total_count=len(services))
+) -> ORJSONResponse:
+    """List a page of services that have stored secrets"""
+    services = await kms.list_services(limit=limit, offset=offset)
+    total_count = await kms.count_services()
+    return ORJSONResponse({"services": services, "total_count": total_count})
 
 @router.delete(
     "/{service_name}",
@@ -97,7 +120,7 @@ async def list_secrets(
 async def delete_secret(
     service_name: str,
     api_key: str = Depends(verify_api_key),
-    kms: AsyncKMS = Depends(get_kms)
+    kms: AsyncKMS = Depends(get_app_kms)
 ) -> None:
     """Delete a stored secret"""
     try:
@@ -116,7 +139,8 @@ async def delete_secret(
 async def create_new_api_key(
     key_name: str,
     ttl_days: int = Query(default=30, gt=0, le=365),
-    current_api_key: str = Depends(verify_api_key)
+    current_api_key: str = Depends(verify_api_key),
+    now: datetime = Depends(get_request_time)
 ) -> APIKeyResponse:
     """Create a new API key with a given name"""
     new_key, created_at = await create_api_key(key_name, ttl_days)
@@ -129,5 +153,21 @@ async def create_new_api_key(
     return APIKeyResponse(
         key_name=key_name,
         api_key=new_key,
-        created_at=str(datetime.now())
-    )
\ No newline at end of file
+        created_at=now
+    )
+
+@router.delete(
+    "/admin/api-keys/{key_name}",
+    status_code=status.HTTP_204_NO_CONTENT,
+    summary="Revoke an API key",
+)
+async def revoke_existing_api_key(
+    key_name: str,
+    current_api_key: str = Depends(verify_api_key)
+) -> None:
+    """Deactivate an API key by name"""
+    if not await revoke_api_key(key_name):
+        raise HTTPException(
+            status_code=status.HTTP_404_NOT_FOUND,
+            detail=f"No API key found with name: {key_name}"
+        )
\ No newline at end of file
@@ -17,6 +17,10 @@ class Settings(BaseSettings):
     APP_DIR: Path = Path.home() / ".py_kms"
     DB_PATH: Path = APP_DIR / "kms.db"
     
+    # Server
+    DEV: bool = False
+    WORKERS: Optional[int] = None
+    
     # Basic logging
     LOG_LEVEL: str = "INFO"
     LOG_FILE: Path = APP_DIR / "kms.log"
@@ -1,12 +1,27 @@
-from typing import AsyncGenerator, Optional
+from typing import Any, AsyncGenerator, Iterable, Optional, Sequence
+import asyncio
 import aiosqlite
 from contextlib import asynccontextmanager
 from pathlib import Path
 
+from .hashing import hash_api_key
+
+_SESSION_PRAGMAS = """
+    PRAGMA busy_timeout = 30000;
+    PRAGMA foreign_keys = ON;
+    PRAGMA synchronous = NORMAL;
+    PRAGMA cache_size = -64000;
+    PRAGMA temp_store = MEMORY;
+    PRAGMA mmap_size = 268435456;
+    PRAGMA wal_autocheckpoint = 1000;
+"""
+
 class AsyncDatabaseManager:
     def __init__(self, db_path: Path):
         self.db_path = Path(db_path)
         self._db: Optional[aiosqlite.Connection] = None
+        # Serializes writers so only one transaction is open on the connection
+        self._write_lock = asyncio.Lock()
         
     async def connect(self) -> None:
         """Initialize the database connection"""
@@ -15,9 +30,9 @@ class AsyncDatabaseManager:
         
         if not self._db:
             self._db = await aiosqlite.connect(str(self.db_path))
-            await self._db.execute("PRAGMA journal_mode = WAL")
-            await self._db.execute("PRAGMA foreign_keys = ON")
-            self._db.row_factory = aiosqlite.Row
+            # WAL mode persists in the database file and is set by init_db;
+            # only session-local settings are applied, in a single round-trip
+            await self._db.executescript(_SESSION_PRAGMAS)
     
     async def disconnect(self) -> None:
         """Close the database connection"""
@@ -26,13 +41,16 @@ class AsyncDatabaseManager:
             self._db = None
 
     @asynccontextmanager
-    async def transaction(self) -> AsyncGenerator[aiosqlite.Connection, None]:
-        """Context manager for database transactions"""
+    async def transaction(
+        self, immediate: bool = False
+    ) -> AsyncGenerator[aiosqlite.Connection, None]:
+        """Context manager for database transactions, optionally taking the
+        database write lock up front to serialize against other processes"""
         if not self._db:
             await self.connect()
             
-        async with self._db.cursor() as cur:
-            await cur.execute("BEGIN")
+        async with self._write_lock, self._db.cursor() as cur:
+            await cur.execute("BEGIN IMMEDIATE" if immediate else "BEGIN")
             try:
                 yield self._db
                 await self._db.commit()
@@ -49,38 +67,143 @@ class AsyncDatabaseManager:
         async with self._db.cursor() as cur:
             yield cur
 
+    async def fetchone(self, sql: str, params: Sequence[Any] = ()) -> Optional[Any]:
+        """Run a single read query and return its first row"""
+        if not self._db:
+            await self.connect()
+            
+        cur = await self._db.execute(sql, params)
+        row = await cur.fetchone()
+        await cur.close()
+        return row
+
+    async def fetchall(self, sql: str, params: Sequence[Any] = ()) -> Iterable[Any]:
+        """Run a single read query and return all of its rows"""
+        if not self._db:
+            await self.connect()
+            
+        return await self._db.execute_fetchall(sql, params)
+
 async def init_db(db_path: Path) -> None:
     """Initialize all database tables"""
     # Ensure directory exists
     db_path.parent.mkdir(parents=True, exist_ok=True)
     
     async with aiosqlite.connect(str(db_path)) as db:
-        # Enable WAL mode and foreign keys
+        # Wait on other workers' locks before anything else touches the file
+        await db.execute("PRAGMA busy_timeout = 30000")
+        
+        # Enable WAL mode, which persists for every later connection, and
+        # foreign keys
         await db.execute("PRAGMA journal_mode = WAL")
         await db.execute("PRAGMA foreign_keys = ON")
+        await db.execute("PRAGMA synchronous = NORMAL")
         
-        # Create tables in a transaction
-        await db.execute("BEGIN")
+        # Create tables in a transaction, taking the write lock up front so
+        # concurrent workers queue instead of failing on lock upgrade
+        await db.execute("BEGIN IMMEDIATE")
         try:
+            # Bring plaintext-key tables up to date, then move them aside so
+            # their keys can be hashed into the new layout below
+            cursor = await db.execute("PRAGMA table_info(api_keys)")
+            columns = {row[1] for row in await cursor.fetchall()}
+            legacy_keys = "api_key" in columns
+            if legacy_keys:
+                if "last_used" not in columns:
+                    await db.execute("ALTER TABLE api_keys ADD COLUMN last_used INTEGER")
+                
+                # Convert expiry timestamps written as ISO text to unix epoch seconds
+                await db.execute("""
+                    UPDATE api_keys
+                    SET expires_at = CAST(strftime('%s', expires_at) AS INTEGER)
+                    WHERE typeof(expires_at) = 'text'
+                """)
+                
+                await db.execute("ALTER TABLE api_keys RENAME TO api_keys_legacy")
+            
             await db.execute("""
                 CREATE TABLE IF NOT EXISTS api_keys (
                     key_id TEXT PRIMARY KEY,
-                    api_key TEXT UNIQUE NOT NULL,
+                    key_hash BLOB UNIQUE NOT NULL,
                     created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
-                    expires_at TIMESTAMP NOT NULL,
-                    is_active BOOLEAN DEFAULT TRUE
+                    expires_at INTEGER NOT NULL,
+                    is_active BOOLEAN DEFAULT TRUE,
+                    last_used INTEGER
                 )
             """)
             
+            if legacy_keys:
+                cursor = await db.execute("""
+                    SELECT key_id, api_key, created_at, expires_at, is_active, last_used
+                    FROM api_keys_legacy
+                """)
+                await db.executemany("""
+                    INSERT INTO api_keys 
+                    (key_id, key_hash, created_at, expires_at, is_active, last_used)
+                    VALUES (?, ?, ?, ?, ?, ?)
+                """, [
+                    (key_id, hash_api_key(api_key), *rest)
+                    for key_id, api_key, *rest in await cursor.fetchall()
+                ])
+                await db.execute("DROP TABLE api_keys_legacy")
+            
+            # Convert last_used values written as datetime text to epoch seconds
+            await db.execute("""
+                UPDATE api_keys
+                SET last_used = CAST(strftime('%s', last_used) AS INTEGER)
+                WHERE typeof(last_used) = 'text'
+            """)
+            
+            # Lookups go through the UNIQUE key index; the planner never chose
+            # this extra index, so remove it where older versions created it
+            await db.execute("DROP INDEX IF EXISTS idx_api_keys_lookup")
+            
+            # Move aside secrets stored as a single encrypted envelope so the
+            # KMS can re-encrypt them into the split layout on startup
+            cursor = await db.execute("PRAGMA table_info(secrets)")
+            columns = {row[1] for row in await cursor.fetchall()}
+            if "encrypted_data" in columns:
+                await db.execute("ALTER TABLE secrets RENAME TO secrets_legacy")
+            
             await db.execute("""
                 CREATE TABLE IF NOT EXISTS secrets (
                     service_name TEXT PRIMARY KEY,
-                    encrypted_data BLOB NOT NULL,
+                    encrypted_secret BLOB NOT NULL,
+                    encrypted_meta BLOB NOT NULL,
                     created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
                     updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
                 )
             """)
             
+            # Row counts maintained by triggers so totals never need a scan
+            await db.execute("""
+                CREATE TABLE IF NOT EXISTS counters (
+                    name TEXT PRIMARY KEY,
+                    n INTEGER NOT NULL
+                )
+            """)
+            await db.execute("""
+                INSERT OR IGNORE INTO counters (name, n)
+                SELECT 'secrets', COUNT(*) FROM secrets
+            """)
+            # Bumped on every API key change so each worker can drop stale
+            # verification cache entries
+            await db.execute("""
+                INSERT OR IGNORE INTO counters (name, n) VALUES ('api_keys', 0)
+            """)
+            await db.execute("""
+                CREATE TRIGGER IF NOT EXISTS secrets_ins AFTER INSERT ON secrets
+                BEGIN
+                    UPDATE counters SET n = n + 1 WHERE name = 'secrets';
+                END
+            """)
+            await db.execute("""
+                CREATE TRIGGER IF NOT EXISTS secrets_del AFTER DELETE ON secrets
+                BEGIN
+                    UPDATE counters SET n = n - 1 WHERE name = 'secrets';
+                END
+            """)
+            
             await db.execute("""
                 CREATE TABLE IF NOT EXISTS master_key (
                     id INTEGER PRIMARY KEY CHECK (id = 1),
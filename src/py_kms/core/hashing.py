@@ -0,0 +1,7 @@
+import hashlib
+
+def hash_api_key(api_key: str) -> bytes:
+    """Hash an API key for storage and lookup"""
+    # The direct constructor skips hashlib.new()'s name lookup and goes
+    # straight to OpenSSL, which uses SHA-NI where the CPU supports it
+    return hashlib.sha256(api_key.encode()).digest()
\ No newline at end of file
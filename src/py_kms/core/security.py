@@ -1,72 +1,208 @@
-﻿from datetime import datetime, timedelta
+﻿import asyncio
+from datetime import datetime, timedelta, timezone
+import hashlib
+import logging
 import secrets
-from typing import Optional, Tuple
-import sqlite3
-from fastapi import Security, HTTPException, status
+import time
+from typing import Dict, Optional, Tuple
+from cachetools import TTLCache
+from fastapi import Request, Security, HTTPException, status
 from fastapi.security import APIKeyHeader
 from py_kms.core.config import settings
-from .database import get_db
+from .database import AsyncDatabaseManager, get_db
+from .hashing import hash_api_key
+
+logger = logging.getLogger(__name__)
 
 API_KEY_HEADER = APIKeyHeader(name="X-API-Key", auto_error=True)
 
-async def create_api_key(key_name: str = "default", ttl_days: int = 30) -> Tuple[str, datetime]:
-    """Create a new API key with expiration"""
-    db = await get_db()
+# Interval between background flushes of API key activity
+ACTIVITY_FLUSH_INTERVAL = 1.0
+
+# How often each worker checks whether API keys changed in another worker
+KEY_GENERATION_CHECK_INTERVAL = 1.0
+
+_BUMP_KEY_GENERATION_SQL = "UPDATE counters SET n = n + 1 WHERE name = 'api_keys'"
+
+# Per-process salt for the cache key digest
+_CACHE_SALT = secrets.token_bytes(16)
+
+# Known keys map to (expires_at, is_active, key_hash, generation); unknown
+# keys are remembered briefly to blunt brute-force probing
+_verify_cache: TTLCache = TTLCache(maxsize=4096, ttl=300)
+_negative_cache: TTLCache = TTLCache(maxsize=4096, ttl=30)
+
+# Last API key generation seen in the database, and when it was read
+_key_generation: Optional[int] = None
+_key_generation_checked = 0.0
+
+# (last_used epoch seconds, key_hash) pairs waiting for the background flusher
+_activity_queue: "asyncio.Queue[Tuple[int, bytes]]" = asyncio.Queue()
+
+def _cache_key(api_key: str) -> bytes:
+    """Hash an API key for use as a cache key"""
+    # blake2b is cheaper than sha256 for short inputs, so cache hits never
+    # need the storage hash
+    return hashlib.blake2b(api_key.encode(), key=_CACHE_SALT, digest_size=16).digest()
+
+def invalidate_api_key_cache() -> None:
+    """Drop all cached API key verification results"""
+    _verify_cache.clear()
+    _negative_cache.clear()
+
+async def _sync_key_generation(db: AsyncDatabaseManager) -> None:
+    """Drop cached results if API keys changed since the last check"""
+    global _key_generation, _key_generation_checked
+    now = time.monotonic()
+    if now - _key_generation_checked < KEY_GENERATION_CHECK_INTERVAL:
+        return
+    _key_generation_checked = now
     
-    async with db.cursor() as cur:
-        # Only check existing if it's not the default key
-        if key_name != "default":
-            await cur.execute(
-                "SELECT 1 FROM api_keys WHERE key_id = ?",
-                (key_name,)
-            )
-            if await cur.fetchone():
-                return None, None
-        
-        api_key = secrets.token_urlsafe(32)
-        expires_at = datetime.utcnow() + timedelta(days=ttl_days)
+    result = await db.fetchone("SELECT n FROM counters WHERE name = 'api_keys'")
+    generation = result[0] if result else 0
+    if generation != _key_generation:
+        invalidate_api_key_cache()
+        _key_generation = generation
+
+def _check_key_state(expires_at: int, is_active: bool) -> None:
+    """Raise if the API key is deactivated or expired"""
+    if not is_active:
+        raise HTTPException(
+            status_code=status.HTTP_403_FORBIDDEN,
+            detail="API key has been deactivated"
+        )
         
-        async with db.transaction() as conn:
-            await conn.execute(
-                """INSERT OR REPLACE INTO api_keys 
-                   (key_id, api_key, expires_at) 
-                   VALUES (?, ?, ?)""",
-                (key_name, api_key, expires_at)
-            )
-            
-        return api_key, expires_at
-
-async def verify_api_key(api_key: str = Security(API_KEY_HEADER)) -> str:
-    """Verify the API key is valid and not expired"""
+    if expires_at < time.time():
+        raise HTTPException(
+            status_code=status.HTTP_403_FORBIDDEN,
+            detail="API key has expired"
+        )
+
+def _record_activity(key_hash: bytes) -> None:
+    """Queue a last_used update without touching the database"""
+    _activity_queue.put_nowait((int(time.time()), key_hash))
+
+async def flush_activity() -> None:
+    """Write all queued API key activity in a single transaction"""
+    latest: Dict[bytes, int] = {}
+    while not _activity_queue.empty():
+        used_at, key_hash = _activity_queue.get_nowait()
+        latest[key_hash] = used_at
+    
+    if not latest:
+        return
+    
+    db = await get_db()
+    async with db.transaction() as conn:
+        await conn.executemany(
+            "UPDATE api_keys SET last_used = ? WHERE key_hash = ?",
+            [(used_at, key_hash) for key_hash, used_at in latest.items()]
+        )
+
+async def flush_activity_loop() -> None:
+    """Periodically flush queued API key activity until cancelled"""
+    while True:
+        await asyncio.sleep(ACTIVITY_FLUSH_INTERVAL)
+        try:
+            await flush_activity()
+        except Exception as e:
+            logger.error(f"Failed to flush API key activity: {e}")
+
+async def create_api_key(
+    key_name: str = "default",
+    ttl_days: int = 30,
+    replace: bool = True
+) -> Tuple[str, datetime]:
+    """Create a new API key with expiration, optionally keeping an existing one"""
     db = await get_db()
     
-    async with db.cursor() as cur:
-        await cur.execute(
-            """SELECT expires_at, is_active 
-               FROM api_keys 
-               WHERE api_key = ?""", 
-            (api_key,)
+    # Only check existing if it's not the default key
+    if key_name != "default":
+        if await db.fetchone(
+            "SELECT 1 FROM api_keys WHERE key_id = ?",
+            (key_name,)
+        ):
+            return None, None
+    
+    api_key = secrets.token_urlsafe(32)
+    expires_at = datetime.now(timezone.utc) + timedelta(days=ttl_days)
+    
+    conflict = "REPLACE" if replace else "IGNORE"
+    async with db.transaction() as conn:
+        cursor = await conn.execute(
+            f"""INSERT OR {conflict} INTO api_keys 
+               (key_id, key_hash, expires_at) 
+               VALUES (?, ?, ?)""",
+            (key_name, hash_api_key(api_key), int(expires_at.timestamp()))
         )
-        result = await cur.fetchone()
-        
-        if not result:
-            raise HTTPException(
-                status_code=status.HTTP_403_FORBIDDEN,
-                detail="Invalid API key"
-            )
-        
-        expires_at, is_active = result
+        if cursor.rowcount == 0:
+            return None, None
+        await conn.execute(_BUMP_KEY_GENERATION_SQL)
+    invalidate_api_key_cache()
         
-        if not is_active:
-            raise HTTPException(
-                status_code=status.HTTP_403_FORBIDDEN,
-                detail="API key has been deactivated"
-            )
-            
-        if datetime.fromisoformat(expires_at) < datetime.now():
-            raise HTTPException(
-                status_code=status.HTTP_403_FORBIDDEN,
-                detail="API key has expired"
-            )
-            
+    return api_key, expires_at
+
+async def revoke_api_key(key_name: str) -> bool:
+    """Deactivate an API key, returning False if it does not exist"""
+    db = await get_db()
+    
+    async with db.transaction() as conn:
+        cursor = await conn.execute(
+            "UPDATE api_keys SET is_active = FALSE WHERE key_id = ?",
+            (key_name,)
+        )
+        revoked = cursor.rowcount > 0
+        if revoked:
+            await conn.execute(_BUMP_KEY_GENERATION_SQL)
+    if revoked:
+        invalidate_api_key_cache()
+    
+    return revoked
+
+async def verify_api_key(
+    request: Request,
+    api_key: str = Security(API_KEY_HEADER)
+) -> str:
+    """Verify the API key is valid and not expired"""
+    db = request.app.state.db
+    await _sync_key_generation(db)
+    # Entries tagged with an older generation were read before a key change
+    # this worker has since seen, so they are treated as misses
+    generation = _key_generation
+    cache_key = _cache_key(api_key)
+    
+    cached = _verify_cache.get(cache_key)
+    if cached is not None and cached[3] == generation:
+        expires_at, is_active, key_hash, _ = cached
+        _check_key_state(expires_at, is_active)
+        _record_activity(key_hash)
+        return api_key
+    
+    if cache_key in _negative_cache:
+        raise HTTPException(
+            status_code=status.HTTP_403_FORBIDDEN,
+            detail="Invalid API key"
+        )
+    
+    key_hash = hash_api_key(api_key)
+    result = await db.fetchone(
+        """SELECT expires_at, is_active 
+           FROM api_keys 
+           WHERE key_hash = ?""",
+        (key_hash,)
+    )
+    
+    if not result:
+        _negative_cache[cache_key] = True
+        raise HTTPException(
+            status_code=status.HTTP_403_FORBIDDEN,
+            detail="Invalid API key"
+        )
+    
+    expires_at, is_active = result
+    _verify_cache[cache_key] = (expires_at, is_active, key_hash, generation)
+    
+    _check_key_state(expires_at, is_active)
+    
+    _record_activity(key_hash)
     return api_key
\ No newline at end of file
@@ -1,9 +1,13 @@
-﻿import logging
+﻿import asyncio
+import logging
+import os
 from fastapi import FastAPI
 from fastapi.middleware.cors import CORSMiddleware
+from fastapi.responses import ORJSONResponse
 from py_kms.core.config import settings
-from py_kms.core.security import create_api_key
+from py_kms.core.security import create_api_key, flush_activity, flush_activity_loop
 from py_kms.core.database import init_db, get_db
+from py_kms.services.kms import get_kms
 from py_kms.api.routes import secrets
 
 # Setup logging
@@ -23,6 +27,7 @@ app = FastAPI(
     openapi_url=f"{settings.API_V1_STR}/openapi.json",
     docs_url=f"{settings.API_V1_STR}/docs",
     redoc_url=f"{settings.API_V1_STR}/redoc",
+    default_response_class=ORJSONResponse,
 )
 
 @app.on_event("startup")
@@ -38,23 +43,31 @@ async def startup_event():
         await init_db(settings.DB_PATH)
         logger.info(f"Database initialized at: {settings.DB_PATH}")
         
-        # Get database connection
-        db = await get_db()
+        # Bind shared services to app state for request handlers
+        db = app.state.db = await get_db()
         logger.info("Database connection established")
         
+        app.state.kms = await get_kms()
+        logger.info("KMS service initialized")
+        
         # Check for existing API keys
-        async with db.cursor() as cur:
-            await cur.execute("SELECT COUNT(*) FROM api_keys")
-            result = await cur.fetchone()
-            key_count = result[0] if result else 0
-            
-            if key_count == 0:
-                # Generate default API key if none exists
-                api_key, expires_at = await create_api_key()
+        result = await db.fetchone("SELECT COUNT(*) FROM api_keys")
+        key_count = result[0] if result else 0
+        
+        if key_count == 0:
+            # Generate default API key if none exists; with several workers
+            # only the first one to insert it gets to report the key
+            api_key, expires_at = await create_api_key(replace=False)
+            if api_key:
                 logger.info(f"Default API key initialized: {api_key}")
                 logger.info(f"Expires at: {expires_at}")
             else:
-                logger.info(f"Found {key_count} existing API keys")
+                logger.info("Default API key was initialized by another worker")
+        else:
+            logger.info(f"Found {key_count} existing API keys")
+        
+        # Persist API key activity off the request path
+        app.state.activity_task = asyncio.create_task(flush_activity_loop())
                 
     except Exception as e:
         logger.error(f"Startup error: {e}")
@@ -64,8 +77,16 @@ async def startup_event():
 async def shutdown_event():
     """Cleanup on shutdown"""
     try:
-        db = await get_db()
-        await db.disconnect()
+        activity_task = getattr(app.state, "activity_task", None)
+        if activity_task:
+            activity_task.cancel()
+            try:
+                await activity_task
+            except asyncio.CancelledError:
+                pass
+        await flush_activity()
+        
+        await app.state.db.disconnect()
         logger.info("Database connection closed")
     except Exception as e:
         logger.error(f"Shutdown error: {e}")
@@ -93,10 +114,22 @@ async def health_check():
 
 if __name__ == "__main__":
     import uvicorn
-    uvicorn.run(
-        "main:app",
-        host="127.0.0.1",
-        port=8000,
-        reload=True,
-        log_level=settings.LOG_LEVEL.lower()
-    )
\ No newline at end of file
+    if settings.DEV:
+        # Reload mode runs a single worker on the default event loop
+        uvicorn.run(
+            "py_kms.main:app",
+            host="127.0.0.1",
+            port=8000,
+            reload=True,
+            log_level=settings.LOG_LEVEL.lower()
+        )
+    else:
+        uvicorn.run(
+            "py_kms.main:app",
+            host="127.0.0.1",
+            port=8000,
+            loop="uvloop",
+            http="httptools",
+            workers=settings.WORKERS or os.cpu_count(),
+            log_level=settings.LOG_LEVEL.lower()
+        )
\ No newline at end of file
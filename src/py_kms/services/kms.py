@@ -1,97 +1,257 @@
 from cryptography.fernet import Fernet
+from cryptography.hazmat.primitives import hashes
+from cryptography.hazmat.primitives.ciphers.aead import AESGCM
+from cryptography.hazmat.primitives.kdf.hkdf import HKDF
 from datetime import datetime
-import json
+import asyncio
 import base64
+import os
+import orjson
 from pathlib import Path
-from typing import Dict, Union, Optional, List
+from typing import Dict, Union, Optional, List, Tuple
 
 from ..core.database import AsyncDatabaseManager, get_db
 
+# Leading byte of AES-GCM ciphertexts; Fernet tokens always start with b"g"
+_AESGCM_FORMAT = b"\x01"
+_NONCE_SIZE = 12
+
+_LEGACY_TABLE_SQL = "SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = 'secrets_legacy'"
+
+def _derive_aead_key(master_key: bytes) -> bytes:
+    """Derive the AES-256-GCM key from the stored Fernet master key"""
+    return HKDF(
+        algorithm=hashes.SHA256(),
+        length=32,
+        salt=None,
+        info=b"py_kms secrets aes-gcm"
+    ).derive(base64.urlsafe_b64decode(master_key))
+
 class AsyncKMS:
-    def __init__(self):
-        self._fernet: Optional[Fernet] = None
+    def __init__(self, db: AsyncDatabaseManager):
+        self._db = db
+        self._master_key: Optional[bytes] = None
+        self._aead: Optional[AESGCM] = None
+        self._pending_writes: List[Tuple[Tuple[str, bytes, bytes], asyncio.Future]] = []
+        self._flush_task: Optional[asyncio.Task] = None
     
     async def initialize(self) -> None:
         """Initialize the KMS service"""
         await self._load_or_create_master_key()
+        await self._migrate_legacy_secrets()
+        await self._migrate_fernet_secrets()
+    
+    def _encrypt(self, data: bytes, aad: bytes) -> bytes:
+        """Encrypt data with AES-GCM, binding it to the given associated data"""
+        nonce = os.urandom(_NONCE_SIZE)
+        return _AESGCM_FORMAT + nonce + self._aead.encrypt(nonce, data, aad)
+    
+    def _decrypt(self, stored: bytes, aad: bytes) -> bytes:
+        """Decrypt data produced by _encrypt"""
+        nonce = stored[1:_NONCE_SIZE + 1]
+        return self._aead.decrypt(nonce, stored[_NONCE_SIZE + 1:], aad)
+    
+    def _encrypt_row(self, service_name: str, secret: bytes, meta: bytes) -> Tuple[bytes, bytes]:
+        """Encrypt a secret and its metadata envelope for the given service"""
+        aad = service_name.encode()
+        return (
+            self._encrypt(secret, aad + b":secret"),
+            self._encrypt(meta, aad + b":meta")
+        )
     
     async def _load_or_create_master_key(self) -> None:
         """Load existing master key or create a new one"""
-        db = await get_db()
-        async with db.cursor() as cur:
-            await cur.execute("SELECT key FROM master_key WHERE id = 1")
-            result = await cur.fetchone()
+        result = await self._db.fetchone("SELECT key FROM master_key WHERE id = 1")
+        
+        if not result:
+            # Generate and store new master key; workers starting together on
+            # a fresh database all converge on whichever insert wins
+            async with self._db.transaction() as conn:
+                await conn.execute(
+                    "INSERT OR IGNORE INTO master_key (id, key) VALUES (1, ?)",
+                    (Fernet.generate_key(),)
+                )
+            result = await self._db.fetchone("SELECT key FROM master_key WHERE id = 1")
+        
+        self._master_key = result[0]
+        self._aead = AESGCM(_derive_aead_key(self._master_key))
+
+    async def _migrate_legacy_secrets(self) -> None:
+        """Re-encrypt secrets stored as a single base64/JSON envelope"""
+        if not await self._db.fetchone(_LEGACY_TABLE_SQL):
+            return
+        
+        # Fernet is only needed to read secrets written before AES-GCM
+        fernet = Fernet(self._master_key)
+        
+        # Other workers may be migrating too; hold the write lock for the
+        # whole copy and re-check the table once it is ours
+        async with self._db.transaction(immediate=True) as conn:
+            cursor = await conn.execute(_LEGACY_TABLE_SQL)
+            if not await cursor.fetchone():
+                return
+            
+            cursor = await conn.execute(
+                "SELECT service_name, encrypted_data, created_at, updated_at FROM secrets_legacy"
+            )
+            migrated = []
+            for service_name, encrypted_data, created_at, updated_at in await cursor.fetchall():
+                secret_info = orjson.loads(fernet.decrypt(encrypted_data))
+                migrated.append((
+                    service_name,
+                    *self._encrypt_row(
+                        service_name,
+                        base64.b64decode(secret_info["secret"]),
+                        orjson.dumps({
+                            "metadata": secret_info["metadata"],
+                            "created_at": secret_info["created_at"]
+                        })
+                    ),
+                    created_at,
+                    updated_at
+                ))
+            
+            await conn.executemany("""
+                INSERT INTO secrets 
+                (service_name, encrypted_secret, encrypted_meta, created_at, updated_at)
+                VALUES (?, ?, ?, ?, ?)
+            """, migrated)
+            await conn.execute("DROP TABLE secrets_legacy")
+
+    async def _migrate_fernet_secrets(self) -> None:
+        """Re-encrypt secrets still stored as Fernet tokens with AES-GCM"""
+        if not await self._db.fetchone(
+            "SELECT 1 FROM secrets WHERE substr(encrypted_secret, 1, 1) != ? LIMIT 1",
+            (_AESGCM_FORMAT,)
+        ):
+            return
+        
+        fernet = Fernet(self._master_key)
+        
+        # Select under the write lock so concurrent workers each see only
+        # rows nobody has migrated yet
+        async with self._db.transaction(immediate=True) as conn:
+            cursor = await conn.execute(
+                "SELECT service_name, encrypted_secret, encrypted_meta FROM secrets "
+                "WHERE substr(encrypted_secret, 1, 1) != ?",
+                (_AESGCM_FORMAT,)
+            )
+            migrated = [
+                (
+                    *self._encrypt_row(
+                        service_name,
+                        fernet.decrypt(encrypted_secret),
+                        fernet.decrypt(encrypted_meta)
+                    ),
+                    service_name
+                )
+                for service_name, encrypted_secret, encrypted_meta in await cursor.fetchall()
+            ]
             
-            if not result:
-                # Generate and store new master key
-                master_key = Fernet.generate_key()
-                async with db.transaction() as conn:
-                    await conn.execute(
-                        "INSERT INTO master_key (id, key) VALUES (1, ?)",
-                        (master_key,)
-                    )
-                self._fernet = Fernet(master_key)
-            else:
-                self._fernet = Fernet(result[0])
+            await conn.executemany("""
+                UPDATE secrets 
+                SET encrypted_secret = ?, encrypted_meta = ?
+                WHERE service_name = ?
+            """, migrated)
 
     async def store_secret(
         self, 
         service_name: str, 
         secret_data: Union[str, bytes],
-        metadata: Optional[Dict] = None
+        metadata: Optional[Dict] = None,
+        created_at: Optional[str] = None
     ) -> None:
-        """Store a secret with optional metadata"""
+        """Store a secret with optional metadata and creation timestamp"""
         if isinstance(secret_data, str):
             secret_data = secret_data.encode()
         
-        secret_info = {
-            "secret": base64.b64encode(secret_data).decode(),
-            "metadata": metadata or {},
-            "created_at": datetime.now().isoformat()
-        }
+        encrypted_secret, encrypted_meta = self._encrypt_row(
+            service_name,
+            secret_data,
+            orjson.dumps({
+                "metadata": metadata or {},
+                "created_at": created_at or datetime.now().isoformat()
+            })
+        )
         
-        encrypted_data = self._fernet.encrypt(json.dumps(secret_info).encode())
-        
-        db = await get_db()
-        async with db.transaction() as conn:
-            await conn.execute("""
-                INSERT OR REPLACE INTO secrets 
-                (service_name, encrypted_data, updated_at)
-                VALUES (?, ?, CURRENT_TIMESTAMP)
-            """, (service_name, encrypted_data))
+        # Queue the row and wait for the commit that includes it; rows queued
+        # while a commit is in flight are grouped into the next one
+        done = asyncio.get_running_loop().create_future()
+        self._pending_writes.append(
+            ((service_name, encrypted_secret, encrypted_meta), done)
+        )
+        if self._flush_task is None:
+            self._flush_task = asyncio.create_task(self._flush_writes())
+        await done
+
+    async def _flush_writes(self) -> None:
+        """Commit queued secrets until no more arrive during a commit"""
+        try:
+            while self._pending_writes:
+                pending, self._pending_writes = self._pending_writes, []
+                try:
+                    await self._store_secrets_batch([row for row, _ in pending])
+                except Exception as e:
+                    for _, done in pending:
+                        if not done.done():
+                            done.set_exception(e)
+                else:
+                    for _, done in pending:
+                        if not done.done():
+                            done.set_result(None)
+        finally:
+            self._flush_task = None
+
+    async def _store_secrets_batch(self, rows: List[Tuple[str, bytes, bytes]]) -> None:
+        """Write encrypted secrets in a single transaction"""
+        # Upsert rather than INSERT OR REPLACE: REPLACE does not fire the
+        # delete trigger, which would leave the secrets counter too high
+        async with self._db.transaction() as conn:
+            await conn.executemany("""
+                INSERT INTO secrets 
+                (service_name, encrypted_secret, encrypted_meta, updated_at)
+                VALUES (?, ?, ?, CURRENT_TIMESTAMP)
+                ON CONFLICT (service_name) DO UPDATE SET
+                    encrypted_secret = excluded.encrypted_secret,
+                    encrypted_meta = excluded.encrypted_meta,
+                    updated_at = excluded.updated_at
+            """, rows)
 
     async def get_secret(self, service_name: str) -> Dict:
         """Retrieve a secret and its metadata"""
-        db = await get_db()
-        async with db.cursor() as cur:
-            await cur.execute("""
-                SELECT encrypted_data 
-                FROM secrets 
-                WHERE service_name = ?
-            """, (service_name,))
-            result = await cur.fetchone()
-            
-            if not result:
-                raise FileNotFoundError(f"No secret found for service: {service_name}")
-            
-            decrypted_data = self._fernet.decrypt(result[0])
-            secret_info = json.loads(decrypted_data.decode())
-            secret_info["secret"] = base64.b64decode(secret_info["secret"])
-            
-            return secret_info
+        result = await self._db.fetchone("""
+            SELECT encrypted_secret, encrypted_meta 
+            FROM secrets 
+            WHERE service_name = ?
+        """, (service_name,))
+        
+        if not result:
+            raise FileNotFoundError(f"No secret found for service: {service_name}")
+        
+        aad = service_name.encode()
+        secret_info = orjson.loads(self._decrypt(result[1], aad + b":meta"))
+        secret_info["secret"] = self._decrypt(result[0], aad + b":secret")
+        
+        return secret_info
+
+    async def list_services(self, limit: int = 500, offset: int = 0) -> List[str]:
+        """List a page of services that have stored secrets"""
+        results = await self._db.fetchall(
+            "SELECT service_name FROM secrets ORDER BY service_name LIMIT ? OFFSET ?",
+            (limit, offset)
+        )
+        return [row[0] for row in results]
 
-    async def list_services(self) -> List[str]:
-        """List all services that have stored secrets"""
-        db = await get_db()
-        async with db.cursor() as cur:
-            await cur.execute("SELECT service_name FROM secrets ORDER BY service_name")
-            results = await cur.fetchall()
-            return [row[0] for row in results]
+    async def count_services(self) -> int:
+        """Return the number of services that have stored secrets"""
+        result = await self._db.fetchone(
+            "SELECT n FROM counters WHERE name = 'secrets'"
+        )
+        return result[0] if result else 0
 
     async def remove_secret(self, service_name: str) -> None:
         """Remove a stored secret"""
-        db = await get_db()
-        async with db.transaction() as conn:
+        async with self._db.transaction() as conn:
             cursor = await conn.execute("""
                 DELETE FROM secrets 
                 WHERE service_name = ?
@@ -106,6 +266,6 @@ async def get_kms() -> AsyncKMS:
     """Get the KMS service instance"""
     global _kms_instance
     if _kms_instance is None:
-        _kms_instance = AsyncKMS()
+        _kms_instance = AsyncKMS(await get_db())
         await _kms_instance.initialize()
     return _kms_instance
\ No newline at end of file